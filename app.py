@@ -2,24 +2,28 @@ import os
 import discord
 import datetime
 import asyncio
-import regex
 import json
-import html
 from dotenv import load_dotenv
 from piazza_api import Piazza
 from discord.ext import tasks, commands
+from question_tracker import UnansweredTracker
+from digest_scheduler import DigestScheduler, InvalidSchedule
+from piazza_updater import PiazzaHandler
+from fetch_planner import FetchPlanner, created_at
 
 load_dotenv()
 PIAZZA_EMAIL = os.getenv('EMAIL')
 PIAZZA_PASSWORD = os.getenv('PASSWORD')
 TOKEN = os.getenv('TOKEN')
-bot = commands.Bot('.')
+TA_CHANNEL = int(os.getenv('TA_CHANNEL', 0)) or None
 # 747259140908384386 bot-commands channel
 
 class PiazzaUpdater(commands.Cog):
-    """Sends daily updates (at 7AM UTC, 12AM PST) to the target_channel from a
+    """Sends daily updates (at 7AM UTC, 12AM PST by default) to the target_channel from a
     specified Piazza forum. Requires an e-mail and password, but if none are
     provided, then they will be asked for in the console (doesn't work for Heroku deploys).
+    Digest times are kept per channel in a schedule file so they survive restarts, and the
+    Piazza session and caches are handed over to the new cog when the extension is reloaded.
 
     Attributes
     ----------
@@ -35,18 +39,63 @@ class PiazzaUpdater(commands.Cog):
         Piazza log-in email
     PASSWORD : `str (optional)` 
         Piazza password
+    TA_CHANNEL : `int (optional)`
+        ID of the channel where TAs are alerted about unanswered questions (no alerts if None)
+    ALERT_HOURS : `float (optional)`
+        Hours a question can stay unanswered before TAs are alerted
+    SCHEDULE : `str (optional)`
+        Path to the file digest times are saved to (defaults to `<ID>_schedule.json`)
+    PLANNER : `FetchPlanner (optional)`
+        Decides how much of the feed is fetched from Piazza
     """
 
-    def __init__(self, bot, TARGET, CLASS, ID, EMAIL=None, PASSWORD=None):
+    def __init__(self, bot, TARGET, CLASS, ID, EMAIL=None, PASSWORD=None, TA_CHANNEL=None, ALERT_HOURS=12, SCHEDULE=None, PLANNER=None):
         self.bot = bot
-        self.p = Piazza()
-        self.p.user_login(email=EMAIL, password=PASSWORD)
         self._nid = ID
         self.classname = CLASS
-        self.cls = self.p.network(self._nid)
         self.url = f'https://piazza.com/class/{self._nid}?cid='
         self.target_channel = TARGET # bot-commands channel
+        self.ta_channel = TA_CHANNEL
+        # if reloaded, reuse the previous cog's session and state instead of logging in again. anything missing
+        # from the snapshot (e.g. it was taken by an older version of this cog) starts fresh
+        snapshot = getattr(bot, 'piazza_snapshots', {}).get(self._nid, {})
+        if 'piazza' in snapshot:
+            self.p = snapshot['piazza']
+        else:
+            self.p = Piazza()
+            self.p.user_login(email=EMAIL, password=PASSWORD)
+        self.cls = snapshot['network'] if 'network' in snapshot else self.p.network(self._nid)
+        self.tracker = snapshot['tracker'] if 'tracker' in snapshot else UnansweredTracker(HOURS=ALERT_HOURS, PATH=f'{self._nid}_reported.json')
+        self._lastCheck = snapshot.get('last_check')
+        self.scheduler = snapshot['scheduler'] if 'scheduler' in snapshot else DigestScheduler(SCHEDULE or f'{self._nid}_schedule.json')
+        self.planner = snapshot['planner'] if 'planner' in snapshot else PLANNER or FetchPlanner()
+        # formats posts for !read and caches resolved images, sharing this cog's session and planner
+        self.handler = snapshot['handler'] if 'handler' in snapshot else PiazzaHandler(CLASS, ID, None, None, None, PLANNER=self.planner, PIAZZA=self.p)
+        if not self.scheduler.jobs: self.scheduler.set(self.target_channel, '07:00', 'UTC')
+        self.tracker.hours = ALERT_HOURS # also moves the deadlines of questions tracked before a reload
         self.sendUpdate.start() # this error is ok, was written this way in the docs 
+        if self.ta_channel: self.checkUnanswered.start()
+        # only dropped once restored, so a failed reload leaves it for the old cog that discord.py rolls back to
+        getattr(bot, 'piazza_snapshots', {}).pop(self._nid, None)
+
+    def cog_unload(self):
+        """Stops the loops and stashes state on the bot so a reloaded cog can pick it up"""
+        self.sendUpdate.cancel()
+        self.checkUnanswered.cancel()
+        if not hasattr(self.bot, 'piazza_snapshots'): self.bot.piazza_snapshots = {}
+        self.bot.piazza_snapshots[self._nid] = self.snapshot()
+
+    def snapshot(self):
+        """Returns everything that should outlive the cog across a reload"""
+        return {
+            'piazza'   : self.p,
+            'network'  : self.cls,
+            'tracker'  : self.tracker,
+            'scheduler': self.scheduler,
+            'handler'  : self.handler,
+            'last_check': self._lastCheck,
+            'planner'  : self.planner,
+        }
 
     # testing update function, but only fires on ready
     @tasks.loop(count=1)
@@ -55,19 +104,63 @@ class PiazzaUpdater(commands.Cog):
         print('Sending piazza update')
         await chnl.send(self.fetch(10))
 
-    @tasks.loop(hours=24)
+    @tasks.loop(minutes=1)
     async def sendUpdate(self):
-        chnl = self.bot.get_channel(self.target_channel)
-        print('Sending piazza update')
-        await chnl.send(self.fetch(10))
+        """Sends the digest to every channel whose scheduled time has passed since its last digest"""
+        digest = None # fetched once per tick and shared by every channel that's due
+        for job in self.scheduler.due():
+            chnl = self.bot.get_channel(job['channel'])
+            if chnl is None: continue
+            try:
+                if digest is None: digest = self.fetch(10, scheduled=True)
+                print(f'Sending piazza update to {job["channel"]}')
+                await chnl.send(digest)
+                self.scheduler.mark_run(job['channel'])
+            except Exception as e: # keep the loop (and other channels' digests) alive, retried next tick
+                print(f'Failed to send piazza update to {job["channel"]}: {e!r}')
 
     @sendUpdate.before_loop
     async def before_sendUpdate(self):
-        today = datetime.datetime.utcnow()
-        postTime = datetime.datetime(today.year, today.month, today.day, hour=7, minute=00, tzinfo=today.tzinfo)
-        timeUntilPost = postTime - today
-        if timeUntilPost.total_seconds() > 0: 
-            await asyncio.sleep(timeUntilPost.total_seconds())
+        await self.bot.wait_until_ready()
+
+    def nextCheck(self):
+        """Returns seconds until the next unanswered-question check: every 10 minutes, or sooner if a 
+            question's deadline comes first (but at most once every 2 minutes)"""
+        if self._lastCheck is None: return 0
+        due = self._lastCheck + datetime.timedelta(minutes=10)
+        deadline = self.tracker.next_deadline()
+        if deadline: due = min(due, max(deadline, self._lastCheck + datetime.timedelta(minutes=2)))
+        return max((due - datetime.datetime.utcnow()).total_seconds(), 0)
+
+    @tasks.loop(seconds=0)
+    async def checkUnanswered(self):
+        """Syncs open questions from the feed (a single request) and alerts TAs about the ones past their deadline.
+            A single timer that sleeps until the next deadline or periodic sync, no per-post polling"""
+        await asyncio.sleep(self.nextCheck())
+        self._lastCheck = datetime.datetime.utcnow()
+        chnl = self.bot.get_channel(self.ta_channel)
+        if chnl is None: return
+        if not self.planner.spend(scheduled=True): # shares the course's rate budget, retried on the next check
+            return print('Skipped unanswered question check, Piazza rate budget exhausted')
+        try:
+            feed = self.cls.get_feed(limit=100, offset=0)['feed']
+        except Exception as e: # a failed request would stop the loop for good, retry on the next tick instead
+            return print(f'Failed to check unanswered questions: {e!r}')
+        self.tracker.sync(self._nid, feed)
+        expired = self.tracker.expired()
+        if not expired: return
+        print(f'Alerting TAs about {len(expired)} unanswered question(s)')
+        response = f'**Unanswered questions in {self.classname} (over {self.tracker.hours:g} hours):**\n'
+        for entry in expired:
+            line = f'@{entry["num"]}: {entry["subject"]} <{self.url}{entry["num"]}>\n'
+            if len(response) + len(line) > 2000: # discord's message limit
+                await chnl.send(response)
+                response = ''
+            response += line
+        await chnl.send(response)
+
+    @checkUnanswered.before_loop
+    async def before_checkUnanswered(self):
         await self.bot.wait_until_ready()
    
     @commands.command()
@@ -85,84 +178,84 @@ class PiazzaUpdater(commands.Cog):
         try:
             isinstance(int(postID), int)
             if postID == '1': raise Exception()
-            post = self.cls.get_post(postID)
+            post = self.handler.get_post(postID)
         except:
             return await ctx.send(f'{postID} not a valid Piazza post ID. Please try again.')
-        postEmbed=self.fetchPost(post,postID)
+        postEmbed=self.fetchPost(post)
         return await ctx.send(embed=postEmbed)
     
+    @commands.command()
+    @commands.guild_only()
+    @commands.has_permissions(manage_channels=True)
+    async def digest(self, ctx, time=None, tz='UTC'):
+        """
+        `!digest` __`HH:MM`__ __`time zone`__
+        **Usage:** !digest [HH:MM | off] [time zone]
+
+        **Examples:**
+        `!digest 08:30 America/Vancouver` sends the daily digest to this channel at 8:30AM Vancouver time
+        `!digest off` stops sending digests to this channel
+        `!digest` shows when this channel gets its digest
+        """
+        if time is None:
+            job = self.scheduler.get(ctx.channel.id)
+            if not job: return await ctx.send('No digest scheduled for this channel.')
+            return await ctx.send(f'Digest is sent daily at {job["time"]} ({job["tz"]}).')
+        if time == 'off':
+            self.scheduler.remove(ctx.channel.id)
+            return await ctx.send('Digest turned off for this channel.')
+        try:
+            self.scheduler.set(ctx.channel.id, time, tz)
+        except InvalidSchedule:
+            return await ctx.send(f'{time} {tz} is not a valid time. Please use HH:MM and a time zone like America/Vancouver.')
+        return await ctx.send(f'Digest will be sent daily at {time} ({tz}).')
+
+    @commands.command()
+    async def fetchplan(self, ctx):
+        """
+        `!fetchplan`
+        **Usage:** !fetchplan
+
+        Shows what the bot has learned about this Piazza's activity and how many posts it fetched recently
+        """
+        return await ctx.send(f'Fetch plan for {self.classname}:\n{self.planner.describe()}')
+
     @commands.command()
     @commands.cooldown(1,5,commands.BucketType.user)
     async def pinned(self, ctx):
-        posts = self.getPinnedPosts(lim=15) # arbitr. number, pinned posts are always the first to be fetched by api
+        posts = self.getPinnedPosts()
         response = f'Pinned posts for {self.classname}:\n'
+        if not self.planner.complete: # ran out of rate budget before reading the pinned posts
+            response += '*Piazza\'s rate limit was reached, some pinned posts may be missing. Try again in a few minutes.*\n'
         for post in posts:
             postNum = post['nr']
-            postSubject = post['history'][0]['subject']
+            postSubject = post['subject']
             response += f'@{postNum}: {postSubject} <{self.url}{postNum}>\n'
         return await ctx.send(response)
      
-    def fetchPost(self, post, postID):
+    def fetchPost(self, post):
         """
         produces Embed object with details for a specific post
         
         Parameters:
-            post (str) - JSON string representing a Piazza post
-            postID (int) - integer for a valid Piazza post ID 
+            post (dict) - post details returned by `PiazzaHandler.get_post()`
         """
-        postEmbed=discord.Embed(title=post['history'][0]['subject'], 
-                            url=f'{self.url}{postID}',
-                            description=f'@{post["nr"]}')
-        postEmbed.add_field(name='Question' if post['type'] != 'note' else 'Note', 
-                            value=self.formatContent(post['history'][0]['content']))
-        answers = post['children']
-        if answers: # check if answers exist
-            answer = answers[0]
-            if answer['type'] == 'followup': # if a followup is the most recent contribution
-                try: # look for another official answer first
-                    if answers[1]['type'] == 'followup': raise Exception()
-                    answerHeading = 'Instructor Answer' if answer['type']=='i_answer' else 'Student Answer'
-                    answer = postEmbed.add_field(name=answerHeading, 
-                                                value=self.formatContent(answers[1]['history'][0]['content']), 
-                                                inline=False) 
-                except: # if it doesn't exist, just default to the followup
-                    postEmbed.add_field(name="Follow-up Post", 
-                                        value=self.formatContent(answer['subject']), 
-                                        inline=False)
-            else: # if it's an actual answer
-                answerContent = answer['history'][0]['content']
-                answerHeading = 'Instructor Answer' if answer['type']=='i_answer' else 'Student Answer'
-                postEmbed.add_field(name=answerHeading, 
-                                    value=self.formatContent(answerContent), 
-                                    inline=False) 
-            if len(answers) > 1: # more discussion exists
-                postEmbed.add_field(name=f'{len(answers)-1} more contribution(s) hidden', 
-                                    value='Click the title above to access the rest of the post.', 
-                                    inline=False)
-        else: # no answer exists yet
-            postEmbed.add_field(name="Answers", value='No answers yet :(', inline=False)
-        postEmbed.set_footer(text=f'tags: {", ".join(post["tags"] if post["tags"] else "None")}')
+        postEmbed=discord.Embed(title=post['subject'], url=post['url'], description=post['num'])
+        postEmbed.add_field(name=post['post_type'], value=post['post_body'])
+        postEmbed.add_field(name=post['ans_type'], value=post['ans_body'], inline=False)
+        if post['more_answers']: # more discussion exists
+            postEmbed.add_field(name=f'{post["num_answers"]-1} more contribution(s) hidden', 
+                                value='Click the title above to access the rest of the post.', 
+                                inline=False)
+        postEmbed.set_footer(text=f'tags: {post["tags"]}')
+        image = self.handler.get_image(post) # only resolved here, when someone actually reads the post
+        if image: postEmbed.set_image(url=image)
         return postEmbed
 
-    def formatContent(self, text):
-        """gets rid of json-formatted text and markdown tags"""
-        result = text
-
-        if len(result) > 1024:
-            result = result[:1000]
-            result += '...\n\n *(Read more of this post by clicking the post title above!)*'
-
-        tagRegex = regex.compile("<.*?>")
-        result = html.unescape(regex.sub(tagRegex,'',result)) 
-        
-        if len(result) < 1: result += 'An image or video was posted'
-        
-        return result
-
-    def fetch(self, showLimit):
-        """Sorts and formats the day's piazza posts"""
+    def fetch(self, showLimit, scheduled=False):
+        """Sorts and formats the day's piazza posts, scheduled digests can use the planner's reserved budget"""
         response = f'**{self.classname}\'s posts for { datetime.date.today() }**\n'
-        posts = self.getPostsToday(lim=50)
+        posts = self.getPostsToday(scheduled)
         instr, qna = [], []
 
         def fetchTag(piazza_post, content, arr, tagged):
@@ -186,60 +279,86 @@ class PiazzaUpdater(commands.Cog):
         # first adds all instructor notes to update, then student notes
         # for student notes, show first 10 and indicate there's more to be seen for today
         for post in posts:
-            fetchTag(post, post['history'][0]['subject'], instr, 'instructor-note')
+            fetchTag(post, post['subject'], instr, 'instructor-note')
 
         if len(posts) <= showLimit:
             for p in posts:
-                fetchTag(p, p['history'][0]['subject'], qna, 'student')
+                fetchTag(p, p['subject'], qna, 'student')
         else:
             for i in range(showLimit+1):
-                fetchTag(posts[i],posts[i]['history'][0]['subject'], qna, 'student')
+                fetchTag(posts[i],posts[i]['subject'], qna, 'student')
             response += f'Showing first {showLimit} posts, {len(posts)-showLimit} more on Piazza\n'
 
+        if not self.planner.complete: # ran out of rate budget before seeing every post
+            response += '*Piazza\'s rate limit was reached, some of today\'s posts may be missing. Check Piazza for the rest.*\n'
+
         response += addPostListing(instr, False)
         response += addPostListing(qna, True)
         return response
     
-    def getPinnedPosts(self, lim=1):
-        posts = self.cls.iter_all_posts(limit=lim)
+    def getPinnedPosts(self):
+        """pinned posts are always at the top of the feed, so only the pinned block 
+            learned by the planner (plus one post to see its end) is read from it"""
+        posts = self.planner.take(self.cls)
         result = []
         for post in posts:
             if post['bucket_name'] and post['bucket_name'] == 'Pinned':
                 result.append(post)
         return result
 
-    def getPostsToday(self, lim=1):
-        """gets up to `lim` posts from Piazza's internal API and returns the ones that 
-            were made today"""
-        if lim > 50:
-            lim = 50
-        elif lim < 1:
-            lim = 1
-        posts = self.cls.iter_all_posts(limit=lim)
+    def getPostsToday(self, scheduled=False):
+        """reads Piazza's feed until the planner has every post since yesterday and 
+            returns the ones that were made today"""
         date = datetime.date.today() # format yyyy-mm-dd
+        since = datetime.datetime.combine(date - datetime.timedelta(days=1), datetime.time())
+        posts = self.planner.take(self.cls, since=since, scheduled=scheduled)
         result = []
         for post in posts:
-            created_at = [int(x) for x in post['created'][:10].split('-')] # [2020,9,19] from 2020-09-19T22:41:52Z might cause an error lol
-            created_at = datetime.date(created_at[0],created_at[1],created_at[2])
-            if (date - created_at).days <= 1:
+            if (date - created_at(post).date()).days <= 1:
                 result.append(post)
         return result
 
 
-@bot.event
-async def on_command_error(ctx,error):
-    if isinstance(error, commands.CommandOnCooldown): await ctx.send("Command on cooldown, please wait 5 seconds.")
+def setup(bot):
+    """Entry point for `bot.load_extension('app')`/`bot.reload_extension('app')`"""
+    bot.add_cog(PiazzaUpdater(bot,479512513378123798,"CPSC221","ke1ukp9g4xx6oi",PIAZZA_EMAIL,PIAZZA_PASSWORD,TA_CHANNEL))
+
+
+if __name__ == '__main__':
+    bot = commands.Bot('.')
+
+    @bot.event
+    async def on_command_error(ctx,error):
+        if isinstance(error, commands.CommandOnCooldown): await ctx.send("Command on cooldown, please wait 5 seconds.")
+        elif isinstance(error, commands.MissingPermissions): await ctx.send("You need the Manage Channels permission to do that.")
+        elif isinstance(error, commands.NoPrivateMessage): await ctx.send("That command only works in a server.")
+        elif isinstance(error, commands.NotOwner): await ctx.send("Only the bot's owner can do that.")
+        elif isinstance(error, commands.CommandNotFound): pass
+        else:
+            print(f'Error in {ctx.command}: {error!r}')
+            if ctx.command and ctx.command.name == 'reload': await ctx.send(f'Reload failed: {error}')
+
+    @bot.event
+    async def on_ready():
+        print('bot ready')
+        print(f'Bot name: {bot.user.name}')
+        print(f'Discord version: {discord.__version__}')
+        if 'app' not in bot.extensions: # on_ready also fires on reconnects
+            bot.load_extension('app')
 
-@bot.event
-async def on_ready():
-    print('bot ready')
-    print(f'Bot name: {bot.user.name}')
-    print(f'Discord version: {discord.__version__}')
-    bot.add_cog(PiazzaUpdater(bot,479512513378123798,"CPSC221","ke1ukp9g4xx6oi",PIAZZA_EMAIL,PIAZZA_PASSWORD))
+    @bot.command()
+    @commands.is_owner()
+    async def reload(ctx):
+        """Reloads the Piazza cog in place, keeping its Piazza session, caches and schedule.
+            Only app.py is reloaded: question_tracker, digest_scheduler, fetch_planner and piazza_updater 
+            aren't, and the restored state is made of instances of their old classes, so fixes to those 
+            modules need a restart"""
+        bot.reload_extension('app')
+        await ctx.send('Reloaded.')
 
-# testing commands!
-@bot.command(aliases=['hi,hello'])
-async def hello(ctx):
-    await ctx.send(f'hello {ctx.author.mention}')
+    # testing commands!
+    @bot.command(aliases=['hi,hello'])
+    async def hello(ctx):
+        await ctx.send(f'hello {ctx.author.mention}')
 
-bot.run(TOKEN)
\ No newline at end of file
+    bot.run(TOKEN)
@@ -0,0 +1,98 @@
+import datetime
+import json
+import os
+from typing import List
+
+try:
+    from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+except ImportError:  # python < 3.9
+    from backports.zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+
+class InvalidSchedule(Exception):
+    pass
+
+class DigestScheduler:
+    """
+    Cron-like daily schedule of digest times, one per channel, each in its own time zone. The schedule and the
+    last time each digest was sent are saved to a JSON file so it resumes correctly after a restart: a digest
+    whose time passed while the bot was down is sent once when it comes back, and nothing is sent twice.
+    Attributes
+    ----------
+    PATH : `str`
+        Path to the JSON file the schedule is saved to
+    """
+
+    def __init__(self, PATH):
+        self.path = PATH
+        self._jobs = {}  # str(channel id) -> job
+        self.load()
+
+    def load(self):
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                self._jobs = json.load(f)
+
+    def save(self):
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(self._jobs, f, indent=2)
+        os.replace(tmp, self.path)
+
+    @property
+    def jobs(self) -> List[dict]:
+        return list(self._jobs.values())
+
+    def get(self, channel) -> dict:
+        return self._jobs.get(str(channel))
+
+    def set(self, channel, time="07:00", tz="UTC", now=None):
+        """
+        Schedules a daily digest for `channel` at `time` (HH:MM, 24h) in time zone `tz`. The first digest is
+        sent at the next occurrence of `time`.
+        """
+
+        try:
+            hour, minute = [int(x) for x in time.split(":")]
+            datetime.time(hour, minute)
+            ZoneInfo(tz)
+        except (ValueError, ZoneInfoNotFoundError):
+            raise InvalidSchedule(f"Invalid digest time: {time} {tz}")
+
+        now = now or datetime.datetime.now(datetime.timezone.utc)
+        self._jobs[str(channel)] = {
+            "channel" : channel,
+            "time"    : f"{hour:02d}:{minute:02d}",
+            "tz"      : tz,
+            "last_run": now.isoformat(),
+        }
+        self.save()
+
+    def remove(self, channel):
+        if self._jobs.pop(str(channel), None) is not None:
+            self.save()
+
+    def due(self, now=None) -> List[dict]:
+        """Returns the jobs whose most recent scheduled time has passed since they were last run"""
+        now = now or datetime.datetime.now(datetime.timezone.utc)
+        return [job for job in self._jobs.values()
+                if self.previous_run(job, now) > datetime.datetime.fromisoformat(job["last_run"])]
+
+    def mark_run(self, channel, now=None):
+        now = now or datetime.datetime.now(datetime.timezone.utc)
+        self._jobs[str(channel)]["last_run"] = now.isoformat()
+        self.save()
+
+    @staticmethod
+    def previous_run(job, now) -> datetime.datetime:
+        """Returns the latest time (in UTC) at or before `now` that `job` was scheduled for"""
+        tz = ZoneInfo(job["tz"])
+        hour, minute = [int(x) for x in job["time"].split(":")]
+        local_now = now.astimezone(tz)
+        day = local_now.date()
+        scheduled = datetime.datetime.combine(day, datetime.time(hour, minute), tzinfo=tz)
+
+        if scheduled > local_now:
+            scheduled = datetime.datetime.combine(day - datetime.timedelta(days=1), datetime.time(hour, minute), tzinfo=tz)
+
+        return scheduled.astimezone(datetime.timezone.utc)
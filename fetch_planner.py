@@ -0,0 +1,247 @@
+import datetime
+import math
+import time
+from collections import deque
+from typing import List
+
+
+def created_at(item) -> datetime.datetime:
+    """
+    Returns the creation time of a feed item (or post). Feed items don't always have "created", so this falls back
+    to the item's "create" log entry, then to its last update.
+    """
+
+    created = item.get("created")
+
+    if not created:
+        log = [entry for entry in item.get("log", []) if entry.get("n") == "create"]
+        created = log[0]["t"] if log else item["updated"]
+
+    # 2020-09-19T22:41:52Z
+    return datetime.datetime.strptime(created[:19], "%Y-%m-%dT%H:%M:%S")
+
+
+def updated_at(item) -> datetime.datetime:
+    """Returns the time of the latest activity on a feed item, or its creation time if it has none"""
+    if item.get("updated"):
+        return datetime.datetime.strptime(item["updated"][:19], "%Y-%m-%dT%H:%M:%S")
+
+    return created_at(item)
+
+
+class FetchPlanner:
+    """
+    Decides how much of a Piazza course's feed to fetch, based on what it has seen of that course so far,
+    instead of fixed limits. Piazza's API is rate-limited, so quiet courses should make as few requests as
+    possible while busy ones must still get every new post.
+    Posts are read from the feed (`Network.get_feed()`), which returns the number, subject, tags, creation and
+    last update time of many posts in a single request, instead of fetching every post on its own. It learns
+    two things from the feed:
+        - the post rate (posts per hour, smoothed), used to size the first feed page of a sync
+        - the size of the pinned block, which is always at the top of the feed
+    The feed is sorted by latest activity, so once a page reaches a post that wasn't updated since the start
+    of the requested range, every post created in the range has been seen. Until then more pages are fetched.
+    Every request to Piazza for the course should be charged to the planner (`spend()`, or `charge()` for requests
+    that happen anyway) so it keeps a single rate budget of `BUDGET` requests per `WINDOW` seconds; unused budget
+    carries over to the next sync (up to `BUDGET`). The last `RESERVE` requests are kept for scheduled syncs
+    (digests, unanswered-question checks) so command traffic can't use up what they need. If the budget runs
+    out before a range is covered, the result is marked incomplete (see `complete`) so callers can say so
+    instead of silently dropping posts.
+    Results are cached for `TTL` seconds, so repeated commands (`!pinned`, digests) don't read the feed again.
+    Attributes
+    ----------
+    FLOOR : `int (optional)`
+        Lower limit on the size of the first feed page of a sync
+    PAGE_MAX : `int (optional)`
+        Upper limit on the size of a feed page
+    BUDGET : `int (optional)`
+        Requests allowed per `WINDOW` seconds
+    WINDOW : `float (optional)`
+        Length in seconds of the rate budget's window
+    SAFETY : `float (optional)`
+        Multiplier on the expected number of new posts, to absorb busier-than-usual days
+    SMOOTHING : `float (optional)`
+        Weight of the latest observation in the post rate (between 0 and 1)
+    RESERVE : `int (optional)`
+        Requests of the budget only scheduled syncs can use
+    TTL : `float (optional)`
+        Seconds results are cached for
+    """
+
+    def __init__(self, FLOOR=5, PAGE_MAX=100, BUDGET=55, WINDOW=120, SAFETY=1.5, SMOOTHING=0.3, RESERVE=10, TTL=120):
+        self.floor = FLOOR
+        self.page_max = PAGE_MAX
+        self.budget = BUDGET
+        self.window = WINDOW
+        self.safety = SAFETY
+        self.smoothing = SMOOTHING
+        self.rate = None  # posts per hour, None until the first sync of a range
+        self.pinned = None  # posts in the pinned block, None until it has been seen end to end
+        self.reserve = RESERVE
+        self.ttl = TTL
+        self.tokens = BUDGET
+        self._refilled = time.monotonic()
+        self._cache = {}  # since -> (time cached, items), complete results only
+        self._complete = True
+        self.decisions = deque(maxlen=20)
+
+    @property
+    def complete(self) -> bool:
+        """False if the latest `take()` ran out of budget before it had every post it was asked for"""
+        return self._complete
+
+    def plan(self, since=None, now=None) -> int:
+        """
+        Returns the size of the first feed page to request to get every post created after `since`, or the
+        pinned posts if `since` is None
+        """
+
+        now = now or datetime.datetime.utcnow()
+
+        if since is None:
+            # one extra post to see where the pinned block ends
+            return min(self.page_max, self.pinned + 1 if self.pinned is not None else 15)
+
+        if self.rate is None:
+            limit = self.page_max // 2
+        else:
+            hours = max((now - since).total_seconds() / 3600, 0)
+            limit = (self.pinned or 0) + math.ceil(self.rate * hours * self.safety) + 2
+
+        return max(self.floor, min(self.page_max, limit))
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.budget, self.tokens + (now - self._refilled) * self.budget / self.window)
+        self._refilled = now
+
+    def spend(self, scheduled=False) -> bool:
+        """
+        Takes one request from the rate budget. Returns False if there's none left right now, in which case the
+        request shouldn't be made. Only `scheduled` syncs can use the reserved part of the budget.
+        """
+
+        self._refill()
+
+        if self.tokens < 1 + (0 if scheduled else self.reserve):
+            return False
+
+        self.tokens -= 1
+        return True
+
+    def charge(self):
+        """Records a request that is made regardless of the budget (e.g. `!read`), so the budget stays accurate"""
+        self._refill()
+        self.tokens -= 1
+
+    def take(self, network, since=None, now=None, scheduled=False) -> List[dict]:
+        """
+        Reads the feed of `network` until every post created after `since` has been seen, or just the pinned
+        block if `since` is None, learns from it and returns the feed items (every item read for the pinned
+        block, only the ones created after `since` otherwise)
+        Parameters
+        ----------
+        network : `piazza_api.network.Network`
+            Piazza network to read the feed of
+        since : `datetime.datetime (optional)`
+            UTC time the requested range starts at
+        scheduled : `bool (optional)`
+            True for scheduled syncs, which can use the reserved part of the budget
+        """
+
+        cached = self._cache.get(since)
+        if cached and time.monotonic() - cached[0] < self.ttl:
+            self._complete = True
+            return cached[1]
+
+        now = now or datetime.datetime.utcnow()
+        planned = limit = self.plan(since, now)
+        items, pages, complete = [], 0, False
+
+        while self.spend(scheduled):
+            page = network.get_feed(limit=limit, offset=len(items))["feed"]
+            items += page
+            pages += 1
+
+            if len(page) < limit or self.covered(items, since):
+                complete = True
+                break
+
+            limit = min(self.page_max, limit * 2)
+
+        self.observe(items, since, now)
+
+        if since is not None:
+            items = [item for item in items if created_at(item) >= since]
+
+        if complete:
+            cached_at = time.monotonic()
+            # `since` moves every day, so drop expired ranges instead of letting them pile up
+            self._cache = {key: entry for key, entry in self._cache.items() if cached_at - entry[0] < self.ttl}
+            self._cache[since] = (cached_at, items)
+
+        self._complete = complete
+        self.record(now, "pinned" if since is None else "range", planned, pages, len(items), complete)
+        return items
+
+    def covered(self, items, since) -> bool:
+        """Returns True if `items` provably contains every post created after `since` (or the whole pinned block)"""
+        regular = [item for item in items if not self.isPinned(item)]
+
+        if since is None:
+            return bool(regular)
+
+        # the feed is sorted by latest activity, so everything after a post not updated since `since` is older
+        return bool(regular) and updated_at(regular[-1]) < since
+
+    def observe(self, items, since, now):
+        """Updates the learned pinned block size and post rate from the feed items of a sync"""
+        if not items:
+            return
+
+        block = 0
+        while block < len(items) and self.isPinned(items[block]):
+            block += 1
+
+        if block < len(items):  # only trust the count if the end of the block was seen
+            self.pinned = block
+
+        hours = (now - since).total_seconds() / 3600 if since else 0
+        if hours >= 1:
+            # if the sync was incomplete this undercounts, but still moves the rate towards busier days
+            sample = sum(1 for item in items if not self.isPinned(item) and created_at(item) >= since) / hours
+            if self.rate is None:
+                self.rate = sample
+            else:
+                self.rate = self.smoothing * sample + (1 - self.smoothing) * self.rate
+
+    def record(self, now, kind, planned, pages, found, complete):
+        decision = {
+            "time"    : now,
+            "kind"    : kind,
+            "planned" : planned,
+            "pages"   : pages,
+            "found"   : found,
+            "complete": complete,
+        }
+        self.decisions.append(decision)
+        print(f"Fetch plan ({kind}): first page {planned}, {pages} request(s), {found} post(s)"
+              + ("" if complete else " (rate budget exhausted, incomplete)"))
+
+    def describe(self) -> str:
+        """Returns a summary of what the planner learned and its latest decisions"""
+        rate = f"{self.rate:.2f} posts/hour" if self.rate is not None else "unknown"
+        pinned = self.pinned if self.pinned is not None else "unknown"
+        response = (f"Post rate: {rate}, pinned posts: {pinned}, "
+                    f"budget: {int(self.tokens)}/{self.budget} requests per {self.window:g}s\n")
+
+        for d in list(self.decisions)[-5:]:
+            response += (f"{d['time']:%Y-%m-%d %H:%M} {d['kind']}: first page {d['planned']}, "
+                         f"{d['pages']} request(s), {d['found']} post(s)"
+                         f"{'' if d['complete'] else ' (incomplete)'}\n")
+
+        return response
+
+    @staticmethod
+    def isPinned(item) -> bool:
+        return item.get("bucket_name") == "Pinned"
@@ -0,0 +1,323 @@
+"""
+Local load generator for the Piazza cogs. Simulates many guilds issuing commands at once against the
+`PiazzaUpdater` cog in app.py and the `PiazzaHandler` layer in piazza_updater.py, with a fake Discord context
+and a fake Piazza network (no tokens or Piazza accounts needed), then reports throughput, tail latency,
+event-loop lag and Piazza calls per command.
+Results cut short by the rate budget (a rate limit warning or `RateLimited`) are counted as incomplete, and
+reads of private posts (rejected with `InvalidPostID`, as expected) as invalid, separately from real errors.
+
+The fake network blocks for `--latency` seconds on every call, like the real (synchronous) piazza_api client,
+so slow Piazza requests show up as event-loop lag the same way they would in production.
+Commands are called directly, so cooldowns and permission checks are not part of the measurement.
+Arrivals are scheduled at absolute times and latency is measured from when a command was due to arrive, so time
+spent waiting behind a blocked event loop counts (no coordinated omission). If the loop falls behind, the arrivals
+it missed are dispatched as soon as it can, with their original timestamps.
+
+Usage:
+    python loadtest.py --guilds 300 --courses 10 --rate 50 --duration 30 --mix read=5,pinned=2,digest=1
+"""
+import argparse
+import asyncio
+import contextvars
+import datetime
+import random
+import tempfile
+import time
+from collections import defaultdict
+from unittest import mock
+
+import app
+import piazza_updater
+
+# name of the command being run by the current task, used to charge Piazza calls to it
+current_command = contextvars.ContextVar("current_command", default="background")
+
+COMMANDS = ["read", "pinned", "digest", "h_read", "h_pinned", "h_digest"]
+
+
+class FakeNetwork:
+    """Stands in for `piazza_api.network.Network` with a generated course"""
+
+    def __init__(self, nid, posts, pinned, latency, calls):
+        self.nid = nid
+        self.latency = latency
+        self.calls = calls
+        now = datetime.datetime.utcnow()
+        self.posts = {}
+
+        for nr in range(posts, 0, -1):
+            created = (now - datetime.timedelta(hours=(posts - nr) * 0.5)).strftime("%Y-%m-%dT%H:%M:%SZ")
+            answered = random.random() < 0.7
+            self.posts[str(nr)] = {
+                "id"         : f"{nid}-{nr}",
+                "nr"         : nr,
+                "type"       : "note" if nr % 7 == 0 else "question",
+                "status"     : "private" if nr % 23 == 0 else "active",
+                "bucket_name": "Pinned" if nr > posts - pinned else "Today",
+                "tags"       : ["instructor-note"] if nr % 7 == 0 else ["student"],
+                "created"    : created,
+                "updated"    : created,
+                "log"        : [{"n": "create", "t": created}],
+                "subject"    : f"Post {nr}",
+                "no_answer"  : 0 if answered else 1,
+                "history"    : [{"subject": f"Post {nr}", "content": f"<p>Body of <b>post {nr}</b></p>" * 20}],
+                "children"   : [{"type": "i_answer", "history": [{"content": "<p>An answer</p>"}]}] if answered else [],
+            }
+
+        self._order = list(self.posts.values())
+        self._by_id = {p["id"]: p for p in self._order}
+
+    def _call(self):
+        self.calls[current_command.get()] += 1
+        time.sleep(self.latency)
+
+    def get_feed(self, limit=100, offset=0):
+        self._call()
+        items = self._order[offset:offset + limit]
+        # like Piazza's feed, items have no "created" (only their log and last update)
+        return {"feed": [{k: v for k, v in p.items() if k not in ("history", "children", "created")} for p in items]}
+
+    def get_post(self, cid):
+        self._call()
+        post = self.posts.get(str(cid)) or self._by_id.get(cid)
+        if post is None:
+            raise Exception(f"Post {cid} not found")
+        return post
+
+    def iter_all_posts(self, limit=None, sleep=0):
+        # same request pattern as piazza_api: one feed request, then one request per post
+        feed = self.get_feed(limit=999999, offset=0)["feed"]
+        for item in feed[:limit]:
+            yield self.get_post(item["id"])
+
+
+class FakePiazza:
+    """Stands in for `piazza_api.Piazza`; `network()` hands out the generated courses"""
+    networks = {}
+
+    def user_login(self, email=None, password=None):
+        pass
+
+    def network(self, nid):
+        return self.networks[nid]
+
+
+class FakeChannel:
+    def __init__(self, id):
+        self.id = id
+        self.sent = 0
+
+    async def send(self, content=None, embed=None):
+        self.sent += 1
+
+
+class FakeGuild:
+    def __init__(self, id):
+        self.id = id
+
+
+class FakeMessage:
+    def __init__(self, content):
+        self.content = content
+
+
+class FakeContext:
+    def __init__(self, guild, channel, content=""):
+        self.guild = guild
+        self.channel = channel
+        self.message = FakeMessage(content)
+        self.replies = []
+
+    async def send(self, content=None, embed=None):
+        self.replies.append(content)
+        await self.channel.send(content, embed=embed)
+
+
+class FakeBot:
+    def __init__(self):
+        self.command_prefix = "."
+        self._channels = {}
+
+    def get_channel(self, id):
+        return self._channels.setdefault(id, FakeChannel(id))
+
+    async def wait_until_ready(self):
+        pass
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def parse_mix(mix):
+    weights = {}
+    for part in mix.split(","):
+        name, weight = part.split("=")
+        if name not in COMMANDS:
+            raise SystemExit(f"Unknown command {name} in --mix, expected one of {', '.join(COMMANDS)}")
+        weights[name] = float(weight)
+    return weights
+
+
+async def run_command(name, arrived, cog, handler, guild, channel, posts, latencies, outcomes):
+    """
+    Runs command `name` and records its latency measured from `arrived`, when it was due to arrive, and its outcome
+    if it didn't fully succeed ("error", "incomplete" or "invalid")
+    """
+
+    current_command.set(name)
+    nr = random.randint(2, posts)
+    ctx = FakeContext(guild, channel, f".read {nr}")
+    outcome = None
+
+    try:
+        # the cogs' replies say when a result was cut short, h_* commands are checked right after the (blocking) call
+        if name == "read":
+            await cog.read.callback(cog, ctx)
+            if "not a valid Piazza post ID" in (ctx.replies[-1] or ""):
+                outcome = "invalid"
+        elif name == "pinned":
+            await cog.pinned.callback(cog, ctx)
+            if "rate limit was reached" in ctx.replies[-1]:
+                outcome = "incomplete"
+        elif name == "digest":
+            digest = cog.fetch(10)
+            if "rate limit was reached" in digest:
+                outcome = "incomplete"
+            await channel.send(digest)
+        elif name == "h_read":
+            handler.get_post(nr)
+        elif name == "h_pinned":
+            handler.get_pinned()
+        elif name == "h_digest":
+            handler.get_posts_in_range(showLimit=10)
+            if not handler.planner.complete:
+                outcome = "incomplete"
+    except piazza_updater.InvalidPostID:
+        outcome = "invalid"
+    except piazza_updater.RateLimited:
+        outcome = "incomplete"
+    except Exception:
+        outcome = "error"
+
+    if outcome:
+        outcomes[name][outcome] += 1
+
+    latencies[name].append(time.perf_counter() - arrived)
+
+
+async def monitor_lag(interval, lags, stop):
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(time.perf_counter() - start - interval)
+
+
+async def main(args):
+    random.seed(args.seed)
+    mix = parse_mix(args.mix)
+    calls = defaultdict(int)
+    latencies = defaultdict(list)
+    outcomes = defaultdict(lambda: defaultdict(int))
+    lags = []
+    schedule_dir = tempfile.mkdtemp()
+    bot = FakeBot()
+    cogs, handlers = [], []
+
+    for c in range(args.courses):
+        nid = f"course{c}"
+        FakePiazza.networks[nid] = FakeNetwork(nid, args.posts, args.pinned, args.latency, calls)
+
+    with mock.patch.object(app, "Piazza", FakePiazza), mock.patch.object(piazza_updater, "Piazza", FakePiazza):
+        for c in range(args.courses):
+            nid = f"course{c}"
+            cogs.append(app.PiazzaUpdater(bot, 1000 + c, f"COURSE{c}", nid, SCHEDULE=f"{schedule_dir}/{nid}.json"))
+            handlers.append(piazza_updater.PiazzaHandler(f"COURSE{c}", nid, None, None, FakeGuild(c)))
+
+    guilds = [(FakeGuild(g), FakeChannel(g)) for g in range(args.guilds)]
+    names, weights = list(mix), list(mix.values())
+    stop = asyncio.Event()
+    monitor = asyncio.ensure_future(monitor_lag(args.lag_interval, lags, stop))
+    tasks = []
+    dispatch_delays = []
+    start = time.perf_counter()
+    end = start + args.duration
+    next_at = start
+
+    # open-loop poisson arrivals: each command is due at an absolute time, whether or not earlier ones finished
+    while True:
+        next_at += random.expovariate(args.rate)
+        if next_at >= end:
+            break
+        now = time.perf_counter()
+        if next_at > now:
+            await asyncio.sleep(next_at - now)
+        dispatch_delays.append(time.perf_counter() - next_at)
+        g = random.randrange(args.guilds)
+        guild, channel = guilds[g]
+        name = random.choices(names, weights)[0]
+        course = g % args.courses
+        tasks.append(asyncio.ensure_future(
+            run_command(name, next_at, cogs[course], handlers[course], guild, channel, args.posts, latencies, outcomes)))
+
+    # arrival rate the generator actually kept up with, measured up to when the last command was dispatched
+    generated = time.perf_counter() - start
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await monitor
+
+    for cog in cogs:
+        cog.cog_unload()
+
+    report(args, latencies, outcomes, calls, lags, dispatch_delays, generated, elapsed)
+
+
+def report(args, latencies, outcomes, calls, lags, dispatch_delays, generated, elapsed):
+    total = sum(len(v) for v in latencies.values())
+    arrivals = len(dispatch_delays)
+    print(f"{args.guilds} guilds, {args.courses} courses, {args.duration:g}s of load, "
+          f"{args.latency * 1000:g}ms per Piazza call")
+    print(f"arrivals: {args.rate:g} cmd/s offered, {arrivals / args.duration:.1f} cmd/s scheduled, "
+          f"{arrivals / max(generated, args.duration):.1f} cmd/s achieved "
+          f"(dispatch delay p99 {percentile(dispatch_delays, 99) * 1000:.1f}ms, "
+          f"max {max(dispatch_delays, default=0) * 1000:.1f}ms)")
+    print(f"completed {total} commands in {elapsed:.1f}s ({total / elapsed:.1f} cmd/s)")
+    print("latency is measured from each command's scheduled arrival time")
+    print("incomplete: cut short by the rate budget, invalid: private posts rejected as expected\n")
+    print(f"{'command':<10}{'count':>7}{'errors':>8}{'incompl':>9}{'invalid':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}{'calls/cmd':>11}")
+
+    for name in COMMANDS:
+        values = latencies.get(name)
+        if not values:
+            continue
+        print(f"{name:<10}{len(values):>7}{outcomes[name]['error']:>8}"
+              f"{outcomes[name]['incomplete']:>9}{outcomes[name]['invalid']:>9}"
+              f"{percentile(values, 50) * 1000:>10.1f}{percentile(values, 95) * 1000:>10.1f}"
+              f"{percentile(values, 99) * 1000:>10.1f}{max(values) * 1000:>10.1f}"
+              f"{calls[name] / len(values):>11.1f}")
+
+    if calls["background"]:
+        print(f"background loops made {calls['background']} Piazza calls")
+
+    print(f"\nevent-loop lag: p50 {percentile(lags, 50) * 1000:.1f}ms, p99 {percentile(lags, 99) * 1000:.1f}ms, "
+          f"max {max(lags, default=0) * 1000:.1f}ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test the Piazza cogs with fake guilds and a fake Piazza")
+    parser.add_argument("--guilds", type=int, default=300, help="number of simulated guilds")
+    parser.add_argument("--courses", type=int, default=10, help="number of Piazza courses shared by the guilds")
+    parser.add_argument("--rate", type=float, default=50, help="command arrivals per second (poisson)")
+    parser.add_argument("--duration", type=float, default=30, help="seconds to generate load for")
+    parser.add_argument("--mix", default="read=5,pinned=2,digest=1",
+                        help=f"weighted command mix, any of {', '.join(COMMANDS)} (h_* go through PiazzaHandler)")
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds each fake Piazza call blocks for")
+    parser.add_argument("--posts", type=int, default=200, help="posts per fake course")
+    parser.add_argument("--pinned", type=int, default=5, help="pinned posts per fake course")
+    parser.add_argument("--lag-interval", type=float, default=0.05, help="event-loop lag sampling interval")
+    parser.add_argument("--seed", type=int, default=0)
+    asyncio.get_event_loop().run_until_complete(main(parser.parse_args()))
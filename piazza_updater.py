@@ -1,36 +1,87 @@
 import datetime
-import html
-import re
 import typing
-from typing import List
+from typing import List, Tuple
 from html.parser import HTMLParser
+from urllib.parse import urljoin
 
 from piazza_api import Piazza
 
+from fetch_planner import FetchPlanner, created_at
+
+
+PIAZZA_URL = "https://piazza.com"
+
 
 # Exception for when a post ID is invalid or the post is private etc.
 class InvalidPostID(Exception):
     pass
 
+# Exception for when Piazza's rate budget ran out before anything could be read
+class RateLimited(Exception):
+    pass
+
 class PiazzaHTMLParser(HTMLParser):
+    """
+    Strips the tags from a post's HTML and, in the same pass, collects the images, uploaded files and links it
+    references as compact `(kind, url)` tuples, where kind is "image", "file" or "link". URLs are kept as
+    they appear in the post (often relative to piazza.com) and only resolved when the post is shown.
+    """
 
     def __init__(self):
+        super().__init__(convert_charrefs=True)
         self.parsed_text = ""
+        self.refs = []
 
     def handle_starttag(self, tag, attrs):
-        if tag == "a":
-            for attr in attrs:
-                if attr[0] == "href":
-                    parsed_text += attr[1]
-                    break
-        
-        parsed_text += self.get_starttag_text()
+        attrs = dict(attrs)
+
+        if tag == "img" and attrs.get("src"):
+            self.refs.append(("image", attrs["src"]))
+        elif tag == "a" and attrs.get("href"):
+            kind = "file" if is_upload(attrs["href"]) else "link"
+            self.refs.append((kind, attrs["href"]))
+
+    def handle_data(self, data):
+        self.parsed_text += data
+
+
+def is_upload(url) -> bool:
+    """Returns True if `url` points to a file uploaded to Piazza rather than an external page"""
+    return "/redirect/s3" in url or "cdn-uploads.piazza.com" in url
+
+
+def resolve_attachment(piazza, url) -> typing.Union[str, None]:
+    """
+    Returns a URL for attachment `url` that Discord can load, or None if it couldn't be resolved. Uploads are served
+    through piazza.com/redirect/s3, which needs a logged in session, so the redirect is followed once (one request)
+    to get the CDN URL.
+    Parameters
+    ----------
+    piazza : `piazza_api.Piazza`
+        Logged in Piazza instance
+    url : `str`
+        URL as it appears in the post
+    """
+
+    url = urljoin(PIAZZA_URL, url)
+
+    if "/redirect/s3" not in url:
+        return url
+
+    try:
+        res = piazza._rpc_api.session.head(url, allow_redirects=False, timeout=5)
+        return res.headers.get("Location")
+    except Exception:
+        return None
+
 
 class PiazzaHandler:
     """
     Handles requests to a specific Piazza network. Requires an e-mail and password, but if none are
     provided, then they will be asked for in the console (doesn't work for Heroku deploys). API is rate-limited
-    (max is 55 posts in about 2 minutes?) so it's recommended to be conservative with FETCH_MAX, FETCH_MIN and only change them if necessary.
+    (max is 55 posts in about 2 minutes?) so posts are read from the feed by a `FetchPlanner`, which learns the course's
+    post rate and pinned posts and keeps to a rate budget shared by every request made for the course. `planner.complete`
+    is False if the last fetch ran out of budget, in which case the result may be missing posts.
     All `fetch_*` functions return JSON directly from Piazza's API and all `get_*` functions parse that JSON.
     Attributes
     ----------
@@ -44,23 +95,26 @@ class PiazzaHandler:
         Piazza password
     GUILD : `discord.Guild`
         Guild assigned to the handler
-    FETCH_MAX : `int (optional)`
-        Upper limit on posts fetched from Piazza.
-    FETCH_MIN: `int (optional)`
-        Lower limit on posts fetched from Piazza. Used as the default value for functions that don't need to fetch a lot of posts
+    PLANNER : `FetchPlanner (optional)`
+        Decides how much of the feed is fetched from Piazza. Defaults to a `FetchPlanner` with a budget of 55 requests per 2 minutes
+    PIAZZA : `piazza_api.Piazza (optional)`
+        Logged in Piazza instance to use instead of logging in with EMAIL and PASSWORD
     """
 
-    def __init__(self, NAME, ID, EMAIL, PASSWORD, GUILD, FETCH_MAX=55, FETCH_MIN=30):
+    def __init__(self, NAME, ID, EMAIL, PASSWORD, GUILD, PLANNER=None, PIAZZA=None):
         self.name = NAME
         self.nid = ID
         self._guild = GUILD
         self._channels = []
         self.url = f"https://piazza.com/class/{self.nid}"
-        self.p = Piazza()
-        self.p.user_login(email=EMAIL, password=PASSWORD)
+        if PIAZZA is None:
+            self.p = Piazza()
+            self.p.user_login(email=EMAIL, password=PASSWORD)
+        else:
+            self.p = PIAZZA
         self.network = self.p.network(self.nid)
-        self.max = FETCH_MAX
-        self.min = FETCH_MIN
+        self.planner = PLANNER or FetchPlanner()
+        self._resolved = {}  # attachment url -> url discord can load, only for successful resolutions
 
     @property
     def piazza_url(self):
@@ -119,6 +173,7 @@ class PiazzaHandler:
             requested post ID
         """
 
+        self.planner.charge()
         post = self.network.get_post(postID)
 
         # TODO: Find actual exceptions
@@ -130,16 +185,12 @@ class PiazzaHandler:
 
         return post
 
-    def fetch_recent_notes(self, lim=55) -> List[dict]:
+    def fetch_recent_notes(self) -> List[dict]:
         """
-        Returns up to `lim` JSON objects representing instructor's notes that were posted today
-        Parameters
-        ----------
-        lim : `int (optional)`
-            Upper limit on posts fetched. Must be in range [FETCH_MIN, FETCH_MAX] (inclusive)
+        Returns feed items (JSON objects) representing instructor's notes that were posted today
         """
 
-        posts = self.fetch_posts_in_range(days=0, seconds=60 * 60 * 5, lim=lim)
+        posts = self.fetch_posts_in_range(days=0, seconds=60 * 60 * 5)
         response = []
 
         for post in posts:
@@ -148,19 +199,20 @@ class PiazzaHandler:
 
         return response
 
-    def fetch_pinned(self, lim: int = 0) -> List[dict]:
+    def fetch_pinned(self) -> List[dict]:
         """
-        Returns up to `lim` JSON objects representing pinned posts\n
-        Since pinned posts are always the first notes shown in a Piazza, lim can be a small value.
-        Parameters
-        ----------
-        lim : `int`
-            Upper limit on posts fetched. Must be in range [FETCH_MIN, FETCH_MAX] (inclusive)
+        Returns feed items (JSON objects) representing pinned posts\n
+        Since pinned posts are always the first notes shown in a Piazza, only the pinned block (as learned by the
+        planner) and the post after it are read from the feed. Raises `RateLimited` if the rate budget ran out before
+        the pinned block could be read.
         """
 
-        posts = self.network.iter_all_posts(limit=lim or self.min)
+        posts = self.planner.take(self.network)
         response = []
 
+        if not self.planner.complete:
+            raise RateLimited("Piazza's rate limit was reached, try again in a few minutes.")
+
         for post in posts:
             if self.checkIfPrivate(post):
                 continue
@@ -170,33 +222,33 @@ class PiazzaHandler:
 
         return response
 
-    def fetch_posts_in_range(self, days=1, seconds=0, lim=55) -> List[dict]:
+    def fetch_posts_in_range(self, days=1, seconds=0) -> List[dict]:
         """
-        Returns up to `lim` JSON objects that represent a Piazza post posted today
+        Returns feed items (JSON objects) that represent Piazza posts posted in the last `days` days (0 for today)
         """
 
-        if lim < 0:
-            raise Exception(f"Invalid lim for fetch_posts_in_days(): {lim}")
+        if days < 0:
+            raise Exception(f"Invalid days for fetch_posts_in_range(): {days}")
 
-        posts = self.network.iter_all_posts(limit=min(self.max, lim))
         date = datetime.date.today()
+        since = datetime.datetime.combine(date - datetime.timedelta(days=days), datetime.time())
+        posts = self.planner.take(self.network, since=since)
         result = []
 
         for post in posts:
-            # [2020,9,19] from 2020-09-19T22:41:52Z
-            created_at = [int(x) for x in post["created"][:10].split("-")]
-            created_at = datetime.date(created_at[0], created_at[1], created_at[2])
+            created = created_at(post).date()
 
             if self.checkIfPrivate(post):
                 continue
-            elif (date - created_at).days <= days and (date - created_at).seconds <= seconds:
+            elif (date - created).days <= days and (date - created).seconds <= seconds:
                 result.append(post)
 
         return result
 
     def get_pinned(self) -> List[dict]:
         """
-        Returns an array of `self.min` objects containing a pinned post's post id, title, and url.
+        Returns an array of objects containing a pinned post's post id, title, and url. Raises `RateLimited` if
+        Piazza's rate limit was reached before the pinned posts could be read.
         """
 
         posts = self.fetch_pinned()
@@ -205,7 +257,7 @@ class PiazzaHandler:
         for post in posts:
             post_details = {
                 "num"    : post["nr"],
-                "subject": post["history"][0]["subject"],
+                "subject": post["subject"],
                 "url"    : f"{self.url}?cid={post['nr']}",
             }
             response.append(post_details)
@@ -225,16 +277,18 @@ class PiazzaHandler:
 
         if post:
             postType = "Note" if post["type"] == "note" else "Question"
+            attachments = []
             response = {
                 "subject"     : self.clean_response(post["history"][0]["subject"]),
                 "num"         : f"@{postID}",
                 "url"         : f"{self.url}?cid={postID}",
                 "post_type"   : postType,
-                "post_body"   : self.clean_response(self.get_body(post)),
+                "post_body"   : self.clean_response(self.get_body(post), attachments),
                 "ans_type"    : "",
                 "ans_body"    : "",
                 "more_answers": False,
-                "num_answers" : 0
+                "num_answers" : 0,
+                "attachments" : attachments,
             }
 
             answers = post["children"]
@@ -245,13 +299,13 @@ class PiazzaHandler:
                 if answer["type"] == "followup":
                     if len(answers) == 1 or answers[1]["type"] == "followup":
                         answerHeading = "Follow-up Post"
-                        answerBody = self.clean_response(answer["subject"])
+                        answerBody = self.clean_response(answer["subject"], attachments)
                     else:
                         answerHeading = "Instructor Answer" if answer["type"] == "i_answer" else "Student Answer"
-                        answerBody = self.clean_response(self.get_body(answers[1]))
+                        answerBody = self.clean_response(self.get_body(answers[1]), attachments)
                 else:
                     answerHeading = "Instructor Answer" if answer["type"] == "i_answer" else "Student Answer"
-                    answerBody = self.clean_response(self.get_body(answer))
+                    answerBody = self.clean_response(self.get_body(answer), attachments)
 
                 if len(answers) > 1:
                     response.update({"more_answers": True})
@@ -262,7 +316,7 @@ class PiazzaHandler:
 
             response.update({"ans_type": answerHeading})
             response.update({"ans_body": answerBody})
-            response.update({"tags": ", ".join(post["tags"] or "None")})
+            response.update({"tags": ", ".join(post["tags"]) or "None"})
             return response
         else:
             return None
@@ -271,7 +325,7 @@ class PiazzaHandler:
         if showLimit < 1:
             raise Exception(f"Invalid showLimit for get_posts_in_range(): {showLimit}")
 
-        posts = self.fetch_posts_in_range(days=days, seconds=seconds, lim=self.max)
+        posts = self.fetch_posts_in_range(days=days, seconds=seconds)
         instr, stud = [], []
         response = []
 
@@ -279,7 +333,7 @@ class PiazzaHandler:
             return {
                 "type"   : tag,
                 "num"    : post["nr"],
-                "subject": self.clean_response(post["history"][0]["subject"]),
+                "subject": self.clean_response(post["subject"]),
                 "url"    : f"{self.url}?cid={post['nr']}"
             }
 
@@ -309,41 +363,90 @@ class PiazzaHandler:
 
     def get_recent_notes(self) -> List[dict]:
         """
-        Fetches `FETCH_MIN` posts, filters out non-important (not instructor notes or pinned) posts and
+        Fetches today's posts, filters out non-important (not instructor notes or pinned) posts and
         returns an array of corresponding post details
         """
 
-        posts = self.fetch_recent_notes(lim=self.min)
+        posts = self.fetch_recent_notes()
         response = []
 
         for post in posts:
             post_details = {
                 "num"    : post["nr"],
-                "subject": self.clean_response(post["history"][0]["subject"]),
+                "subject": self.clean_response(post["subject"]),
                 "url"    : f"{self.url}?cid={post['nr']}"
             }
             response.append(post_details)
 
         return response
 
+    def get_image(self, post) -> typing.Union[str, None]:
+        """
+        Returns a URL Discord can load for the first image in a post returned by `get_post()`, or None if it has
+        no images. Only call this when the post is actually shown since resolving an upload costs a request, which is
+        charged to the planner (if there's no budget left the unresolved URL is returned).
+        """
+
+        for kind, url in post.get("attachments", []):
+            if kind == "image":
+                if url not in self._resolved:
+                    if "/redirect/s3" in url and not self.planner.spend():
+                        return urljoin(PIAZZA_URL, url)
+                    resolved = resolve_attachment(self.p, url)
+                    if resolved is None:  # not cached, so the next time the post is shown tries again
+                        return urljoin(PIAZZA_URL, url)
+                    self._resolved[url] = resolved
+                return self._resolved[url]
+
+        return None
+
     @staticmethod
     def checkIfPrivate(post) -> bool:
         return post["status"] == "private"
 
     @staticmethod
-    def clean_response(res):
+    def parse_content(res) -> Tuple[str, List[Tuple[str, str]]]:
+        """Returns the text of HTML string `res` without tags, and the images, files and links it references"""
+        parser = PiazzaHTMLParser()
+        parser.feed(res)
+        parser.close()
+        return parser.parsed_text, parser.refs
+
+    @staticmethod
+    def clean_response(res, attachments=None):
+        """
+        Strips the tags from `res` and truncates it to fit in an embed field. If `attachments` is given, the
+        references found in `res` are appended to it.
+        """
+
+        res, refs = PiazzaHandler.parse_content(res)
+
+        if attachments is not None:
+            attachments.extend(refs)
+
         if len(res) > 1024:
             res = res[:1000]
             res += "...\n\n *(Read more)*"
 
-        tagRegex = re.compile("<.*?>")
-        res = html.unescape(re.sub(tagRegex, "", res))
-
-        if len(res) < 1:
-            res += "An image or video was posted in response."
+        if len(res.strip()) < 1:
+            res = PiazzaHandler.describe_refs(refs)
 
         return res
 
+    @staticmethod
+    def describe_refs(refs) -> str:
+        """Placeholder text for a body that only contains attachments"""
+        images = sum(1 for kind, _ in refs if kind == "image")
+        others = [urljoin(PIAZZA_URL, url) for kind, url in refs if kind != "image"]
+        lines = []
+
+        if images:
+            lines.append(f"{images} image(s) attached")
+        for url in others[:3]:
+            lines.append(f"<{url}>")
+
+        return "\n".join(lines) or "Nothing to show, open the post on Piazza."
+
     @staticmethod
     def get_body(res):
         body = res["history"][0]["content"]
@@ -0,0 +1,179 @@
+import datetime
+import heapq
+import json
+import os
+from typing import List, Union
+
+from fetch_planner import created_at
+
+
+class UnansweredTracker:
+    """
+    Keeps track of unanswered Piazza questions so TAs can be pinged when one has been waiting for too long.
+    Open questions are stored in a min-heap keyed by the time they should be reported, so checking for
+    expired questions only looks at the top of the heap instead of every post. The tracker is updated from
+    the lightweight feed returned by `Network.get_feed()` (one request per sync), which is sorted by last
+    activity, so a question that gets answered shows up again at the top of the feed and is dropped.
+    Answered questions are removed lazily: they're forgotten right away and their heap entries are
+    skipped once they reach the top.
+    Questions that were already reported are saved to a JSON file (if `PATH` is given) so TAs aren't alerted
+    about them again after a restart.
+    Attributes
+    ----------
+    HOURS : `float (optional)`
+        Number of hours a question can go unanswered before it is reported
+    PATH : `str (optional)`
+        Path to the JSON file reported questions are saved to (not saved if None)
+    """
+
+    def __init__(self, HOURS=12, PATH=None):
+        self.delay = datetime.timedelta(hours=HOURS)
+        self.path = PATH
+        self._heap = []  # (deadline, nid, nr), may contain entries for answered posts
+        self._open = {}  # (nid, nr) -> entry
+        self._reported = set()  # (nid, nr) of expired questions that are still unanswered
+        self.load()
+
+    def __len__(self):
+        return len(self._open)
+
+    def __contains__(self, key):
+        return key in self._open
+
+    def load(self):
+        if self.path and os.path.exists(self.path):
+            with open(self.path) as f:
+                self._reported = {(nid, nr) for nid, nr in json.load(f)}
+
+    def save(self):
+        if not self.path:
+            return
+
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(sorted(self._reported), f)
+        os.replace(tmp, self.path)
+
+    @property
+    def hours(self):
+        return self.delay.total_seconds() / 3600
+
+    @hours.setter
+    def hours(self, hours):
+        """Changes the delay, moving the deadlines of questions that are already tracked along with it"""
+        delay = datetime.timedelta(hours=hours)
+
+        if delay == self.delay:
+            return
+
+        for entry in self._open.values():
+            entry["deadline"] += delay - self.delay
+
+        self.delay = delay
+        self._rebuild()
+
+    def sync(self, nid, feed) -> int:
+        """
+        Updates the tracker with a list of feed items from Piazza network `nid` and returns the number of
+        questions that started being tracked
+        Parameters
+        ----------
+        nid : `str`
+            ID of the Piazza network the feed belongs to
+        feed : `List[dict]`
+            Feed items as returned in `Network.get_feed()["feed"]`
+        """
+
+        added = 0
+
+        for item in feed:
+            if self.isUnanswered(item):
+                if self.track(nid, item):
+                    added += 1
+            else:
+                self.resolve(nid, item["nr"])
+
+        return added
+
+    def track(self, nid, item) -> bool:
+        """
+        Starts tracking the question described by feed item `item`. Returns False if it is already tracked
+        or has already been reported
+        """
+
+        key = (nid, item["nr"])
+
+        if key in self._open or key in self._reported:
+            return False
+
+        entry = {
+            "nid"     : nid,
+            "num"     : item["nr"],
+            "subject" : item.get("subject", ""),
+            "deadline": created_at(item) + self.delay,
+        }
+        self._open[key] = entry
+        heapq.heappush(self._heap, (entry["deadline"], nid, item["nr"]))
+        self._compact()
+        return True
+
+    def resolve(self, nid, nr):
+        """Stops tracking post `nr` of network `nid`, usually because it has been answered"""
+        self._open.pop((nid, nr), None)
+
+        if (nid, nr) in self._reported:
+            self._reported.remove((nid, nr))
+            self.save()
+
+    def expired(self, now=None) -> List[dict]:
+        """
+        Removes and returns every tracked question whose deadline is before `now` (defaults to the current
+        UTC time), oldest first. Returned questions are not reported again unless they get answered and
+        become unanswered again.
+        """
+
+        now = now or datetime.datetime.utcnow()
+        result = []
+
+        while self._heap and self._heap[0][0] <= now:
+            deadline, nid, nr = heapq.heappop(self._heap)
+            entry = self._open.get((nid, nr))
+
+            if entry is None or entry["deadline"] != deadline:
+                continue
+
+            del self._open[(nid, nr)]
+            self._reported.add((nid, nr))
+            result.append(entry)
+
+        if result:
+            self.save()
+
+        return result
+
+    def next_deadline(self) -> Union[datetime.datetime, None]:
+        """Returns the earliest deadline of a tracked question, or None if nothing is tracked"""
+        while self._heap:
+            deadline, nid, nr = self._heap[0]
+            entry = self._open.get((nid, nr))
+
+            if entry is not None and entry["deadline"] == deadline:
+                return deadline
+
+            heapq.heappop(self._heap)
+
+        return None
+
+    def _compact(self):
+        # stale entries of answered posts are normally dropped when they reach the top, but rebuild the heap
+        # if they start to outnumber the live ones so memory stays proportional to the open questions
+        if len(self._heap) > 2 * len(self._open) + 64:
+            self._rebuild()
+
+    def _rebuild(self):
+        self._heap = [(e["deadline"], e["nid"], e["num"]) for e in self._open.values()]
+        heapq.heapify(self._heap)
+
+    @staticmethod
+    def isUnanswered(item) -> bool:
+        return item.get("type") == "question" and bool(item.get("no_answer")) and item.get("status") != "private"